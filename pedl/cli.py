@@ -5,17 +5,20 @@ import logging
 import os
 import sys
 from collections import defaultdict
+from contextlib import nullcontext
 from pathlib import Path
 
+import numpy as np
 from torch import nn
+from torch.utils.data import DataLoader
 from tqdm import tqdm
 import torch
-from transformers import BertTokenizerFast
 
-from pedl.model import BertForDistantSupervision
-from pedl.dataset import PEDLDataset
+from pedl.model import BertForDistantSupervision, OnnxBertEncoder
+from pedl.dataset import PEDLDataset, PairDataset, ScoreCache
 from pedl.utils import DataGetter, get_geneid_to_name, build_summary_table, \
-    get_hgnc_symbol_to_gene_id, chunks, Entity
+    get_hgnc_symbol_to_gene_id, get_tokenizer_and_config, get_model_cache_key, prefetch, Entity, \
+    cache_root
 
 
 def summarize(args):
@@ -69,6 +72,8 @@ def predict(args):
     pairs_to_query = []
     for p1 in maybe_mapped_p1s:
         for p2 in maybe_mapped_p2s:
+            if p1 == p2:
+                continue
             pairs_to_query.append((p1, p2))
             if not args.skip_reverse:
                 pairs_to_query.append((p2, p1))
@@ -82,48 +87,129 @@ def predict(args):
         else:
             args.device = "cpu"
 
-    model = BertForDistantSupervision.from_pretrained(args.model)
-    if "cuda" in args.device:
-        model.bert = nn.DataParallel(model.bert)
-    model.eval()
-    model.to(args.device)
+    if not args.precision:
+        args.precision = "fp16" if "cuda" in args.device else "fp32"
+    elif args.precision == "fp16" and "cuda" not in args.device:
+        print("--precision fp16 is only supported on CUDA. Use --precision bf16 on CPU instead. Aborting.")
+        sys.exit(1)
 
-    universe = set(maybe_mapped_p1s + maybe_mapped_p2s)
-    data_getter = DataGetter(universe, local_pubtator=args.pubtator,
-                             api_fallback=args.api_fallback,
-                             expand_species=args.expand_species
-                             )
-    tokenizer = BertTokenizerFast.from_pretrained(args.model)
-    tokenizer.add_special_tokens({ 'additional_special_tokens': ['<e1>','</e1>', '<e2>', '</e2>'] +
-                                                                [f'<protein{i}/>' for i in range(1, 47)]})
-    model.config.e1_id = tokenizer.convert_tokens_to_ids("<e1>")
-    model.config.e2_id = tokenizer.convert_tokens_to_ids("<e2>")
+    if args.quantize:
+        if "cuda" in args.device:
+            print("Int8 quantization is only supported on CPU. Ignoring --quantize.")
+            args.quantize = False
+        elif args.precision != "fp32":
+            print("--quantize cannot be combined with --precision fp16/bf16. Aborting.")
+            sys.exit(1)
+        elif args.backend == "onnx":
+            # the encoder runs in ONNX Runtime and the session can't be copied by quantize_dynamic
+            print("--quantize cannot be combined with --backend onnx. Aborting.")
+            sys.exit(1)
 
-    geneid_to_name = get_geneid_to_name()
+    if args.backend == "onnx":
+        try:
+            import onnxruntime
+        except ImportError:
+            print("The onnx backend requires onnxruntime. "
+                  "Please install via `pip install onnxruntime' (or `onnxruntime-gpu' for CUDA support).")
+            sys.exit(1)
+        args.onnx_path = cache_root / "onnx" / (get_model_cache_key(args.model) + ".onnx")
+        if not args.onnx_path.exists():
+            logging.info(f"Exporting {args.model} to {args.onnx_path}")
+            OnnxBertEncoder.export(load_model(args.model, *get_tokenizer_and_config(args.model)).bert,
+                                   args.onnx_path)
+
+    universe = set(maybe_mapped_p1s + maybe_mapped_p2s)
 
     os.makedirs(args.out, exist_ok=True)
 
     if args.dbs:
         try:
-            from pedl.database import PathwayCommonsDB
+            import pedl.database
         except ImportError:
             print("Harvesting interactions from databases requires indra."
                   "Please install via `pip install indra' for obtaining additional interactions from databases.")
             sys.exit(1)
+
+    n_gpus = torch.cuda.device_count() if args.device == "cuda" else 1
+    if n_gpus > 1:
+        # one process per GPU, each handling its own share of the pairs. Only cheap arguments
+        # are passed, the data getter and databases are built inside of each process.
+        torch.multiprocessing.spawn(_predict_worker, nprocs=n_gpus,
+                                    args=(n_gpus, args, pairs_to_query, universe))
+    else:
+        _predict_worker(0, 1, args, pairs_to_query, universe)
+
+
+def load_model(model_name_or_path, tokenizer, config):
+    try:
+        model = BertForDistantSupervision.from_pretrained(model_name_or_path, config=config,
+                                                          attn_implementation="sdpa")
+    except (ValueError, ImportError):
+        # transformers or torch version without SDPA attention for BERT
+        model = BertForDistantSupervision.from_pretrained(model_name_or_path, config=config)
+
+    n_trained_tokens = model.get_input_embeddings().num_embeddings
+    if len(tokenizer) > n_trained_tokens:
+        raise ValueError(f"{model_name_or_path} has no trained embeddings for "
+                         f"{len(tokenizer) - n_trained_tokens} of the entity marker tokens.")
+
+    return model
+
+
+def _predict_worker(rank, n_workers, args, pairs_to_query, universe):
+    if n_workers > 1:
+        args.device = f"cuda:{rank}"
+        torch.cuda.set_device(rank)
+        pairs_to_query = pairs_to_query[rank::n_workers]
+
+    data_getter = DataGetter(gene_universe=universe, chemical_universe=set(),
+                             local_pubtator=args.pubtator,
+                             api_fallback=args.api_fallback,
+                             expand_species=args.expand_species
+                             )
+    tokenizer, config = get_tokenizer_and_config(args.model)
+
+    geneid_to_name = get_geneid_to_name()
+
+    if args.dbs:
+        from pedl.database import PathwayCommonsDB
         logging.info("Preparing databases")
         dbs = [PathwayCommonsDB(i, gene_universe=universe) for i in args.dbs]
     else:
         dbs = []
 
+    if args.precision == "fp32":
+        autocast = nullcontext()
+    else:
+        autocast = torch.autocast(device_type=args.device.split(":")[0],
+                                  dtype=torch.bfloat16 if args.precision == "bf16" else torch.float16)
+    pin_memory = "cuda" in args.device
 
-    pbar = tqdm(total=len(pairs_to_query))
-    for p1, p2 in pairs_to_query:
+    model = load_model(args.model, tokenizer, config)
+    if args.backend == "onnx":
+        model.bert = OnnxBertEncoder(args.onnx_path, device=args.device)
+    model.eval()
+    model.to(args.device)
+    if args.quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    if args.compile:
+        model.forward = torch.compile(model.forward, dynamic=True)
+
+    dataset = PairDataset(pairs_to_query, data_getter=data_getter, tokenizer=tokenizer,
+                          batch_size=args.batch_size)
+    loader = DataLoader(dataset, batch_size=None, num_workers=args.num_workers,
+                        pin_memory=pin_memory)
+    if args.num_workers == 0:
+        # no worker processes: still retrieve the next pairs while the model is busy
+        loader = prefetch(loader)
+
+    id_to_label = np.array([PEDLDataset.id_to_label[i] for i in range(len(PEDLDataset.id_to_label))])
+    score_cache = ScoreCache()
+    pbar = tqdm(total=len(pairs_to_query), position=rank)
+    for p1, p2, all_sentences, batches, retired_keys in loader:
         name1 = geneid_to_name.get(p1, p1)
         name2 = geneid_to_name.get(p2, p2)
         pbar.set_description(f"{name1}-{name2}")
-        if p1 == p2:
-            pbar.update()
-            continue
 
         processed_db_results = set()
         path_out = args.out / f"{name1}-{name2}.txt"
@@ -139,35 +225,24 @@ def predict(args):
                         f.write(db_result)
                     processed_db_results.add(db_result)
 
-            probs = []
-            all_sentences = []
-            processed_sentences = set()
-
-            for sentences_chunk in data_getter.get_sentences(p1 ,p2):
-                sentences = sorted(sentences_chunk, key=lambda x: len(x.text))
-                sentences = [i for i in sentences if i.text not in processed_sentences]
-                processed_sentences.update(i.text for i in sentences)
-                all_sentences += sentences
-                for sentences_batch in chunks(sentences, args.batch_size):
-                    tensors = tokenizer.batch_encode_plus([i.text_blinded for i in sentences_batch],
-                                                          truncation=True, max_length=512)
-                    max_length = max(len(i) for i in tensors["input_ids"])
-                    tensors = tokenizer.pad(tensors, max_length=max_length,
-                                            return_tensors="pt")
-                    input_ids = tensors["input_ids"].to(args.device)
-                    attention_mask = tensors["attention_mask"].to(args.device)
-                    with torch.no_grad():
-                        x, meta = model(input_ids, attention_mask)
-                    probs_batch = torch.sigmoid(meta["alphas_by_rel"])
-                    probs.append(probs_batch)
-
             if not all_sentences:
                 pbar.update()
                 if os.path.getsize(path_out) == 0:
                     os.remove(path_out)
                 continue
 
-            probs = torch.cat(probs)
+            probs = torch.empty((len(all_sentences), model.num_labels), device=args.device)
+            for indices_batch, input_ids, attention_mask in batches:
+                input_ids = input_ids.to(args.device, non_blocking=True)
+                attention_mask = attention_mask.to(args.device, non_blocking=True)
+                with torch.no_grad(), autocast:
+                    x, meta = model(input_ids, attention_mask, return_alphas=False)
+                probs[indices_batch] = torch.sigmoid(meta["alphas_by_rel"])
+            probs = probs.cpu().numpy() # single device sync per pair for the post-processing below
+
+            # sentences that were already scored for an earlier pair are not batched again
+            keys = [PairDataset.text_key(sentence.text_blinded) for sentence in all_sentences]
+            score_cache.update(keys, batches, probs, retired_keys)
 
             if (probs < args.cutoff).all():
                 pbar.update()
@@ -175,13 +250,14 @@ def predict(args):
                     os.remove(path_out)
                 continue
 
-            for max_score in torch.sort(probs.view(-1), descending=True)[0]:
-                if max_score.item() < args.cutoff:
-                    continue
-                for i, j in zip(*torch.where(probs == max_score)):
-                    label = PEDLDataset.id_to_label[j.item()]
-                    sentence = all_sentences[i]
-                    f.write(f"{label}\t{max_score.item():.2f}\t{sentence.pmid}\t{sentence.text}\tPEDL\n\n")
+            flat_probs = probs.reshape(-1)
+            result_indices = np.flatnonzero(flat_probs >= args.cutoff)
+            result_indices = result_indices[np.argsort(-flat_probs[result_indices], kind="stable")]
+            sentence_indices, label_indices = np.divmod(result_indices, probs.shape[1])
+            for score, i, label in zip(flat_probs[result_indices].tolist(), sentence_indices.tolist(),
+                                       id_to_label[label_indices].tolist()):
+                sentence = all_sentences[i]
+                f.write(f"{label}\t{score:.2f}\t{sentence.pmid}\t{sentence.text}\tPEDL\n\n")
 
         pbar.update()
         if os.path.getsize(path_out) == 0:
@@ -269,6 +345,23 @@ def main():
     parser_predict.add_argument('--topk', type=int, default=None)
     parser_predict.add_argument('--cutoff', type=float, default=0.01)
     parser_predict.add_argument('--batch_size', type=int, default=50)
+    parser_predict.add_argument('--precision', choices=["fp32", "fp16", "bf16"], default=None,
+                                help="Inference precision. Defaults to fp16 on CUDA and fp32 on CPU, "
+                                     "where fp16 is not available.")
+    parser_predict.add_argument('--backend', choices=["torch", "onnx"], default="torch",
+                                help="Run the BERT encoder with PyTorch or, after a one-time export, "
+                                     "with ONNX Runtime (requires onnxruntime and torch>=1.13).")
+    parser_predict.add_argument('--quantize', action="store_true",
+                                help="Quantize all linear layers to int8 for faster CPU inference. "
+                                     "Not available with --backend onnx.")
+    parser_predict.add_argument('--compile', action="store_true",
+                                help="Compile the model with torch.compile (requires torch>=2.0).")
+    parser_predict.add_argument('--num_workers', type=int, default=0,
+                                help="Number of processes that retrieve and tokenize sentences while "
+                                     "the model is running. With the default of 0, this is done in a "
+                                     "background thread instead. Note that every worker process ends up "
+                                     "with its own copy of a local PubTator index and sends its own "
+                                     "PubTator API requests.")
     parser_predict.add_argument('--api_fallback', action="store_true")
     parser_predict.add_argument('--skip_reverse', action="store_true")
     parser_predict.add_argument('--verbose', action="store_true")
@@ -1,12 +1,15 @@
+import hashlib
 import json
 import logging
 import random
-from collections import Counter
+from collections import Counter, OrderedDict
 
 import torch
-from torch.utils.data import Dataset, Sampler
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
 from transformers import BertTokenizerFast
 
+from pedl.utils import Entity, bucket_by_length, chunks
+
 logger = logging.getLogger(__name__)
 
 
@@ -126,3 +129,124 @@ class PEDLDataset(Dataset):
                 labels[self.label_to_id[rel]] = 1
         return labels
 
+
+class PairDataset(IterableDataset):
+    """
+    Retrieves the sentences of each (p1, p2) pair and tokenizes them into length-bucketed
+    batches. Used with a `DataLoader` so that retrieval and tokenization of upcoming pairs
+    happens in worker processes while the model processes the current pair.
+
+    Yields tuples `(p1, p2, sentences, batches, retired_keys)` where each batch is a tuple
+    `(indices, input_ids, attention_mask)` and `indices` refers to `sentences`.
+    Each blinded text is batched only once per iterator, i.e. sentences whose
+    blinded text was already batched for this or an earlier pair are not part of
+    any batch and their scores have to be reused from the first occurrence.
+    To bound memory, only the `max_batched_texts` most recently seen texts are
+    remembered (by `text_key`). `retired_keys` lists the keys that were forgotten
+    while processing the pair; their scores are not needed for later pairs of
+    this iterator anymore, but may still be needed for the current one.
+    """
+
+    def __init__(self, pairs, data_getter, tokenizer, batch_size, max_length=512,
+                 max_batched_texts=100_000):
+        self.pairs = pairs
+        self.data_getter = data_getter
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.max_batched_texts = max_batched_texts
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            pairs = self.pairs
+        else:
+            pairs = self.pairs[worker_info.id::worker_info.num_workers]
+
+        batched_texts = OrderedDict()
+        for p1, p2 in pairs:
+            sentences = self.get_sentences(p1, p2)
+            batches, retired_keys = self.get_batches(sentences, batched_texts)
+            yield p1, p2, sentences, batches, retired_keys
+
+    @staticmethod
+    def text_key(text):
+        # stable across processes, unlike hash()
+        return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    def get_sentences(self, p1, p2):
+        sentences = []
+        processed_sentences = set()
+        for sentences_chunk in self.data_getter.get_sentences(Entity(cuid=p1, type="Gene"),
+                                                              Entity(cuid=p2, type="Gene")):
+            for sentence in sentences_chunk:
+                if sentence.text not in processed_sentences:
+                    processed_sentences.add(sentence.text)
+                    sentences.append(sentence)
+
+        return sentences
+
+    def get_batches(self, sentences, batched_texts):
+        new_indices = []
+        for i, sentence in enumerate(sentences):
+            key = self.text_key(sentence.text_blinded)
+            if key in batched_texts:
+                batched_texts.move_to_end(key)
+            else:
+                batched_texts[key] = None
+                new_indices.append(i)
+        retired_keys = []
+        while len(batched_texts) > self.max_batched_texts:
+            retired_keys.append(batched_texts.popitem(last=False)[0])
+        if not new_indices:
+            return [], retired_keys
+
+        encoding = self.tokenizer([sentences[i].text_blinded for i in new_indices], padding=False,
+                                  truncation=True, max_length=self.max_length,
+                                  return_token_type_ids=False)
+        lengths = [len(input_ids) for input_ids in encoding["input_ids"]]
+        batches = []
+        for bucket in bucket_by_length(lengths):
+            for indices_batch in chunks(bucket, self.batch_size):
+                # pad each batch on its own, so that only its longest sentence determines the size
+                batch_encoding = self.tokenizer.pad(
+                    {"input_ids": [encoding["input_ids"][i] for i in indices_batch],
+                     "attention_mask": [encoding["attention_mask"][i] for i in indices_batch]},
+                    padding="longest", return_tensors="pt")
+                batches.append(([new_indices[i] for i in indices_batch],
+                                batch_encoding["input_ids"], batch_encoding["attention_mask"]))
+
+        return batches, retired_keys
+
+
+class ScoreCache:
+    """
+    Keeps the scores of texts batched by one or several `PairDataset` iterators, so that
+    sentences which an iterator did not batch again can reuse them. A score is kept as
+    long as at least one iterator that batched the text has not retired it yet.
+    """
+
+    def __init__(self):
+        self.key_to_entry = {} # text key -> [scores, number of iterators that remember the text]
+
+    def __len__(self):
+        return len(self.key_to_entry)
+
+    def update(self, keys, batches, scores, retired_keys):
+        """
+        Store the rows of `scores` that belong to sentences in `batches`, fill all rows of
+        `scores` from the cache and afterwards apply `retired_keys`. `keys` holds the text
+        key of each sentence, i.e. of each row of `scores`.
+        """
+        for indices_batch, _, _ in batches:
+            for i in indices_batch:
+                if keys[i] in self.key_to_entry: # batched by another iterator as well
+                    self.key_to_entry[keys[i]][1] += 1
+                else:
+                    self.key_to_entry[keys[i]] = [scores[i].copy(), 1]
+        for i, key in enumerate(keys):
+            scores[i] = self.key_to_entry[key][0]
+        for key in retired_keys:
+            self.key_to_entry[key][1] -= 1
+            if self.key_to_entry[key][1] == 0:
+                del self.key_to_entry[key]
@@ -1,6 +1,7 @@
 from torch import nn
 import torch
 from transformers import BertPreTrainedModel, BertModel, BertTokenizerFast
+from transformers.modeling_outputs import BaseModelOutput
 import numpy as np
 
 
@@ -12,37 +13,103 @@ class BertForDistantSupervision(BertPreTrainedModel):
         self.bert = BertModel(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         self.classifier = nn.Linear(config.hidden_size*2, self.num_labels)
+        self._marker_ids = None
 
         self.init_weights()
 
-    def forward(self, input_ids, attention_mask, use_max=False, **kwargs):
+    def get_marker_ids(self, device):
+        # The ids are read from the config on every call, so that they can be set after
+        # `from_pretrained`, but the tensor is only rebuilt when they or the device change.
+        marker_ids = (self.config.e1_id, self.config.e2_id)
+        if (self._marker_ids is None or self._marker_ids[0] != marker_ids
+                or self._marker_ids[1].device != device):
+            self._marker_ids = (marker_ids, torch.tensor(marker_ids, device=device))
+
+        return self._marker_ids[1]
+
+    def forward(self, input_ids, attention_mask, use_max=False, return_alphas=True, **kwargs):
         bert_out = self.bert(input_ids, attention_mask=attention_mask)
         x = bert_out.last_hidden_state
-        e1_mask = (input_ids == self.config.e1_id).long()
-        e2_mask = (input_ids == self.config.e2_id).long()
-        e1_idx = e1_mask.argmax(dim=1)
-        e2_idx = e2_mask.argmax(dim=1)
-        e1_idx[e1_mask.sum(dim=1) == 0] = 0 # default to [CLS] if entity was truncated
-        e2_idx[e2_mask.sum(dim=1) == 0] = 0 # default to [CLS] if entity was truncated
-        e1_embs = x[torch.arange(len(e1_idx)), e1_idx]
-        e2_embs = x[torch.arange(len(e2_idx)), e2_idx]
-        x = torch.cat([e1_embs, e2_embs], dim=1)
+        marker_ids = self.get_marker_ids(input_ids.device)
+        marker_mask = input_ids.unsqueeze(-1) == marker_ids # locate both markers in one pass
+        # argmax returns the first hit, or 0 (i.e. [CLS]) if the marker was truncated
+        marker_idx = marker_mask.int().argmax(dim=1)
+        marker_embs = x.gather(1, marker_idx.unsqueeze(-1).expand(-1, -1, x.size(-1)))
+        x = marker_embs.view(len(marker_idx), -1) # [e1_emb; e2_emb]
         x = self.dropout(x)
 
-        logits = self.classifier(x)
+        # keep the classification head in fp32 when running under autocast
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            logits = self.classifier(x.float())
+        if not return_alphas:
+            # bag-level scores and per-sentence alphas are only needed for training
+            return None, {'alphas_by_rel': logits}
+
         if use_max:
             alphas = torch.max(logits, dim=1)[0]
+            x = torch.max(logits, dim=0)[0]
         else:
             alphas = torch.logsumexp(logits, dim=1)
+            x = torch.logsumexp(logits, dim=0)
         meta = {
             'alphas': alphas,
             'alphas_by_rel': logits,
             'alphas_hist': np.histogram(alphas.detach().cpu().numpy())
         }
 
-        if use_max:
-            x = torch.max(logits, dim=0)[0]
+        return x, meta
+
+
+class OnnxBertEncoder(nn.Module):
+    """
+    Drop-in replacement for `BertForDistantSupervision.bert` that runs an exported
+    BERT encoder with ONNX Runtime. Only `last_hidden_state` is computed, the
+    entity marker lookup and the classifier stay in PyTorch.
+    """
+
+    def __init__(self, path, device="cpu"):
+        super().__init__()
+        import onnxruntime as ort
+
+        if "cuda" in device:
+            providers = [("CUDAExecutionProvider", {"device_id": torch.device(device).index or 0}),
+                         "CPUExecutionProvider"]
         else:
-            x = torch.logsumexp(logits, dim=0)
+            providers = ["CPUExecutionProvider"]
+        self.session = ort.InferenceSession(str(path), providers=providers)
 
-        return x, meta
+    @staticmethod
+    def export(bert, path):
+        class LastHiddenState(nn.Module):
+            def __init__(self, bert):
+                super().__init__()
+                self.bert = bert
+
+            def forward(self, input_ids, attention_mask):
+                return self.bert(input_ids, attention_mask=attention_mask).last_hidden_state
+
+        # padded batch of two, so that neither the batch size nor the mask gets specialised
+        dummy_input_ids = torch.full((2, 16), bert.config.pad_token_id, dtype=torch.long)
+        dummy_input_ids[0, :] = 1
+        dummy_input_ids[1, :8] = 1
+        dummy_attention_mask = (dummy_input_ids != bert.config.pad_token_id).long()
+        dynamic_axes = {"input_ids": {0: "batch", 1: "sequence"},
+                        "attention_mask": {0: "batch", 1: "sequence"},
+                        "last_hidden_state": {0: "batch", 1: "sequence"}}
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(".tmp")
+        with torch.no_grad():
+            torch.onnx.export(LastHiddenState(bert).eval(), (dummy_input_ids, dummy_attention_mask),
+                              str(temp_path),
+                              input_names=["input_ids", "attention_mask"],
+                              output_names=["last_hidden_state"],
+                              dynamic_axes=dynamic_axes, opset_version=17)
+        temp_path.replace(path)
+
+    def forward(self, input_ids, attention_mask, **kwargs):
+        last_hidden_state = self.session.run(["last_hidden_state"], {
+            "input_ids": input_ids.cpu().numpy(),
+            "attention_mask": attention_mask.cpu().numpy()
+        })[0]
+
+        return BaseModelOutput(last_hidden_state=torch.from_numpy(last_hidden_state).to(input_ids.device))
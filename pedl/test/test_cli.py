@@ -0,0 +1,69 @@
+import pickle
+import sys
+
+import pytest
+import torch
+from transformers import BertConfig
+
+import pedl.cli
+from pedl.model import BertForDistantSupervision
+
+
+def test_predict_multi_gpu_passes_only_cheap_arguments(tmp_path, monkeypatch):
+    spawn_calls = []
+
+    def spawn(fn, nprocs, args):
+        pickle.dumps(args)  # spawn has to pickle the arguments for every process
+        spawn_calls.append((fn, nprocs, args))
+
+    def data_getter(*args, **kwargs):
+        raise AssertionError("DataGetter must only be built inside of the GPU processes")
+
+    monkeypatch.setattr(pedl.cli, "get_hgnc_symbol_to_gene_id", lambda: {})
+    monkeypatch.setattr(pedl.cli, "DataGetter", data_getter)
+    monkeypatch.setattr(torch.cuda, "device_count", lambda: 2)
+    monkeypatch.setattr(torch.multiprocessing, "spawn", spawn)
+    monkeypatch.setattr(sys, "argv", ["pedl", "predict", "--p1", "1", "--p2", "2", "3",
+                                      "--out", str(tmp_path / "out"), "--device", "cuda"])
+
+    pedl.cli.main()
+
+    assert len(spawn_calls) == 1
+    fn, nprocs, (n_gpus, args, pairs_to_query, universe) = spawn_calls[0]
+    assert fn is pedl.cli._predict_worker
+    assert nprocs == n_gpus == 2
+    assert sorted(pairs_to_query) == [("1", "2"), ("1", "3"), ("2", "1"), ("3", "1")]
+    assert universe == {"1", "2", "3"}
+
+
+def test_load_model_rejects_missing_marker_embeddings(tmp_path):
+    config = BertConfig(vocab_size=100, hidden_size=16, num_hidden_layers=1, num_attention_heads=2,
+                        intermediate_size=32, max_position_embeddings=64, e1_id=98, e2_id=99)
+    model = BertForDistantSupervision(config)
+    model.save_pretrained(str(tmp_path))
+
+    assert pedl.cli.load_model(str(tmp_path), tokenizer=range(100), config=model.config) is not None
+    with pytest.raises(ValueError):
+        pedl.cli.load_model(str(tmp_path), tokenizer=range(101), config=model.config)
+
+
+def test_predict_rejects_quantize_with_onnx_backend(tmp_path, monkeypatch):
+    monkeypatch.setattr(pedl.cli, "get_hgnc_symbol_to_gene_id", lambda: {})
+    monkeypatch.setattr(sys, "argv", ["pedl", "predict", "--p1", "1", "--p2", "2",
+                                      "--out", str(tmp_path / "out"), "--device", "cpu",
+                                      "--backend", "onnx", "--quantize"])
+
+    with pytest.raises(SystemExit):
+        pedl.cli.main()
+    assert not (tmp_path / "out").exists()
+
+
+def test_predict_rejects_fp16_on_cpu(tmp_path, monkeypatch):
+    monkeypatch.setattr(pedl.cli, "get_hgnc_symbol_to_gene_id", lambda: {})
+    monkeypatch.setattr(sys, "argv", ["pedl", "predict", "--p1", "1", "--p2", "2",
+                                      "--out", str(tmp_path / "out"), "--device", "cpu",
+                                      "--precision", "fp16"])
+
+    with pytest.raises(SystemExit):
+        pedl.cli.main()
+    assert not (tmp_path / "out").exists()
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from pedl.dataset import PairDataset, ScoreCache
+from pedl.utils import Sentence
+
+
+class WhitespaceTokenizer:
+    def __init__(self):
+        self.vocab = {}
+
+    def __call__(self, texts, max_length, **kwargs):
+        input_ids = [[self.vocab.setdefault(token, len(self.vocab) + 1) for token in text.split()[:max_length]]
+                     for text in texts]
+        return {"input_ids": input_ids, "attention_mask": [[1] * len(i) for i in input_ids]}
+
+    def pad(self, encoding, **kwargs):
+        length = max(len(i) for i in encoding["input_ids"])
+        return {key: torch.tensor([i + [0] * (length - len(i)) for i in values])
+                for key, values in encoding.items()}
+
+
+def test_pair_dataset_get_batches():
+    tokenizer = WhitespaceTokenizer()
+    dataset = PairDataset([], data_getter=None, tokenizer=tokenizer, batch_size=2, max_batched_texts=3)
+    batched_texts = OrderedDict()
+    sentences = [Sentence("a b c", 0, text_blinded="a b c"),
+                 Sentence("d", 0, text_blinded="d"),
+                 Sentence("e f", 0, text_blinded="e f"),
+                 Sentence("a b c.", 0, text_blinded="a b c")]
+
+    batches, retired_keys = dataset.get_batches(sentences, batched_texts)
+    assert retired_keys == []
+    # sorted by length and padded to the longest sentence of each batch
+    assert [indices for indices, _, _ in batches] == [[1, 2], [0]]
+    indices, input_ids, attention_mask = batches[0]
+    assert input_ids.tolist() == [[tokenizer.vocab["d"], 0], [tokenizer.vocab["e"], tokenizer.vocab["f"]]]
+    assert attention_mask.tolist() == [[1, 0], [1, 1]]
+    assert batches[1][1].shape == (1, 3)
+
+    # "e f" was already batched and "d" is the least recently seen text
+    batches, retired_keys = dataset.get_batches([Sentence("e f", 0, text_blinded="e f"),
+                                                 Sentence("g", 0, text_blinded="g")], batched_texts)
+    assert [indices for indices, _, _ in batches] == [[1]]
+    assert retired_keys == [PairDataset.text_key("d")]
+
+
+def get_scores(*values):
+    return np.array([[value] for value in values], dtype=np.float32)
+
+
+def test_score_cache_reuses_scores_within_one_iterator():
+    cache = ScoreCache()
+    a, b = PairDataset.text_key("a"), PairDataset.text_key("b")
+
+    scores = get_scores(0.1, 0.2)
+    cache.update([a, b], [([0, 1], None, None)], scores, retired_keys=[])
+    scores = get_scores(np.nan, 0.3)  # "a" was not batched again
+    cache.update([a, PairDataset.text_key("c")], [([1], None, None)], scores, retired_keys=[a])
+
+    assert scores.tolist() == get_scores(0.1, 0.3).tolist()
+    assert len(cache) == 2
+
+
+def test_score_cache_keeps_scores_until_all_iterators_retired_them():
+    cache = ScoreCache()
+    a = PairDataset.text_key("a")
+
+    # two iterators (e.g. DataLoader workers) batched the same text
+    cache.update([a], [([0], None, None)], get_scores(0.1), retired_keys=[])
+    cache.update([a], [([0], None, None)], get_scores(0.1), retired_keys=[])
+
+    cache.update([], [], get_scores(), retired_keys=[a])  # first iterator forgot it
+    scores = get_scores(np.nan)
+    cache.update([a], [], scores, retired_keys=[a])  # second iterator reuses and then forgets it
+    assert scores.tolist() == get_scores(0.1).tolist()
+    assert len(cache) == 0
@@ -0,0 +1,50 @@
+import pytest
+import torch
+from transformers import BertConfig
+
+from pedl.model import BertForDistantSupervision, OnnxBertEncoder
+
+
+def get_tiny_model():
+    config = BertConfig(vocab_size=100, hidden_size=16, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=32, max_position_embeddings=64, e1_id=98, e2_id=99)
+    return BertForDistantSupervision(config).eval()
+
+
+def test_forward_uses_entity_marker_embeddings():
+    model = get_tiny_model()
+    classifier_inputs = []
+    model.classifier.register_forward_hook(lambda module, inputs, output: classifier_inputs.append(inputs[0]))
+
+    input_ids = torch.tensor([[2, 5, 98, 6, 99, 7],
+                              [2, 99, 5, 98, 0, 0],
+                              [2, 5, 6, 98, 0, 0]])  # tail marker truncated
+    attention_mask = (input_ids != 0).long()
+    with torch.no_grad():
+        _, meta = model(input_ids, attention_mask, return_alphas=False)
+        hidden = model.bert(input_ids, attention_mask=attention_mask).last_hidden_state
+
+    expected = torch.stack([torch.cat([hidden[0, 2], hidden[0, 4]]),
+                            torch.cat([hidden[1, 3], hidden[1, 1]]),
+                            torch.cat([hidden[2, 3], hidden[2, 0]])])
+    assert meta["alphas_by_rel"].shape == (3, model.num_labels)
+    assert torch.allclose(classifier_inputs[0], expected, atol=1e-6)
+
+
+def test_onnx_encoder_matches_bert(tmp_path):
+    pytest.importorskip("onnxruntime")
+    bert = get_tiny_model().bert
+    path = tmp_path / "bert.onnx"
+    OnnxBertEncoder.export(bert, path)
+    encoder = OnnxBertEncoder(path)
+
+    input_ids = torch.tensor([[2, 5, 98, 6, 99, 7, 8],
+                              [2, 99, 5, 98, 0, 0, 0],
+                              [2, 5, 0, 0, 0, 0, 0]])
+    attention_mask = (input_ids != 0).long()
+    with torch.no_grad():
+        expected = bert(input_ids, attention_mask=attention_mask).last_hidden_state
+    actual = encoder(input_ids, attention_mask).last_hidden_state
+
+    assert actual.shape == expected.shape
+    assert torch.allclose(actual, expected, atol=1e-4)
@@ -1,5 +1,8 @@
-from pedl.utils import replace_consistently
+from pedl.utils import replace_consistently, bucket_by_length, prefetch, load_with_pickle_cache, \
+    get_model_cache_key, get_tokenizer_cache_dir
+import os
 import numpy as np
+import pytest
 
 
 def test_replace_consistently():
@@ -35,3 +38,79 @@ def test_replace_consistently():
     text, offsets = replace_consistently(offsets[1], lengths[1], "<entity2/>", text, offsets)
     assert text == "Some <e1><entity2/></e1> might be <e2><entity2/></e2>dish in <entity1/>"
 
+
+def test_bucket_by_length():
+    lengths = [100, 12, 600, 40, 30, 512, 33]
+
+    buckets = bucket_by_length(lengths)
+    assert buckets == [[1, 4], [6, 3], [0], [5, 2]]
+
+    assert bucket_by_length([]) == []
+    assert bucket_by_length(lengths, boundaries=(64,)) == [[1, 4, 6, 3, 0, 5, 2]]
+
+
+def test_prefetch():
+    assert list(prefetch(range(10))) == list(range(10))
+    assert list(prefetch([])) == []
+
+    def failing():
+        yield 1
+        raise ValueError("broken")
+
+    it = prefetch(failing())
+    assert next(it) == 1
+    with pytest.raises(ValueError):
+        next(it)
+
+
+def test_load_with_pickle_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr("pedl.utils.cache_root", tmp_path / "cache")
+    source = tmp_path / "mapping.txt"
+    source.write_text("a\t1\n")
+    n_loads = 0
+
+    def load():
+        nonlocal n_loads
+        n_loads += 1
+        return dict(line.split("\t") for line in source.read_text().splitlines())
+
+    assert load_with_pickle_cache(source, load) == {"a": "1"}
+    assert load_with_pickle_cache(source, load) == {"a": "1"}
+    assert n_loads == 1
+
+    # same file name in another installation
+    other_source = tmp_path / "other" / "mapping.txt"
+    other_source.parent.mkdir()
+    other_source.write_text("b\t2\n")
+    assert load_with_pickle_cache(other_source, lambda: {"b": "2"}) == {"b": "2"}
+    assert load_with_pickle_cache(source, load) == {"a": "1"}
+
+
+def test_get_model_cache_key(tmp_path):
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    config_file = model_dir / "config.json"
+    config_file.write_text("{}")
+
+    key = get_model_cache_key(str(model_dir))
+    assert key == get_model_cache_key(str(model_dir))
+    assert "/" not in key
+
+    config_file.write_text('{"vocab_size": 10}')
+    stat = config_file.stat()
+    os.utime(config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert get_model_cache_key(str(model_dir)) != key
+
+
+def test_get_tokenizer_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr("pedl.utils.cache_root", tmp_path / "cache")
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    (model_dir / "config.json").write_text("{}")
+
+    cache_dir = get_tokenizer_cache_dir(str(model_dir))
+    assert cache_dir.parent == tmp_path / "cache" / "tokenizers"
+    assert get_tokenizer_cache_dir(str(model_dir)) == cache_dir
+
+    monkeypatch.setattr("pedl.utils.SPECIAL_TOKENS", ["<e1>", "</e1>", "<e2>", "</e2>"])
+    assert get_tokenizer_cache_dir(str(model_dir)) != cache_dir
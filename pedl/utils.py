@@ -1,15 +1,20 @@
 import gzip
+import hashlib
 import json
 import logging
 import multiprocessing as mp
 import os
 import pickle
+import queue
 import re
 import shutil
 import tempfile
+import threading
 import warnings
+from bisect import bisect_left
 from collections import defaultdict
 from dataclasses import dataclass
+from functools import lru_cache
 from operator import itemgetter
 from pathlib import Path
 from time import time
@@ -21,7 +26,9 @@ import requests
 from lxml import etree
 import bioc
 import numpy as np
+from transformers import BertConfig, BertTokenizerFast
 from transformers.file_utils import default_cache_path
+from transformers.utils import cached_file
 from segtok.segmenter import split_multi
 
 
@@ -33,6 +40,18 @@ if not cache_root.exists():
 
 root = Path(__file__).parent
 
+# Markers that `DataGetter.get_sentence` puts around the two entities of a sentence.
+# These are the marker tokens the released models were trained with (see `PEDLDataset`).
+ENTITY_MARKERS = {
+    "head_start": "<e1>",
+    "head_end": "</e1>",
+    "tail_start": "<e2>",
+    "tail_end": "</e2>",
+}
+
+# Special tokens that `get_tokenizer_and_config` adds to the tokenizer of a model
+SPECIAL_TOKENS = list(ENTITY_MARKERS.values()) + [f'<protein{i}/>' for i in range(1, 47)]
+
 
 class Sentence:
     def __init__(
@@ -55,12 +74,11 @@ class Sentence:
         return str(self)
 
     def get_unmarked_text(self):
-        return (
-            self.text.replace("<e1>", "")
-            .replace("</e1>", "")
-            .replace("<e2>", "")
-            .replace("</e2>", "")
-        )
+        text = self.text
+        for marker in ENTITY_MARKERS.values():
+            text = text.replace(marker, "")
+
+        return text
 
 
 class SegtokSentenceSplitter:
@@ -103,6 +121,47 @@ def chunks(lst, n):
         yield lst[i : i + n]
 
 
+def bucket_by_length(lengths, boundaries=(32, 64, 128, 256, 512)):
+    """
+    Group the indices of `lengths` into buckets of sequences that are at most as long
+    as the bucket boundary. Indices are sorted by length within each bucket and
+    sequences longer than the largest boundary end up in the last bucket.
+    """
+    buckets = [[] for _ in boundaries]
+    for idx in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        bucket_idx = min(bisect_left(boundaries, lengths[idx]), len(boundaries) - 1)
+        buckets[bucket_idx].append(idx)
+
+    return [bucket for bucket in buckets if bucket]
+
+
+def prefetch(iterable, n_prefetch=2):
+    """
+    Iterate over `iterable` in a background thread that stays up to `n_prefetch`
+    items ahead of the consumer. Exceptions raised by `iterable` are re-raised
+    in the consuming thread.
+    """
+    q = queue.Queue(maxsize=n_prefetch)
+    end = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                q.put((item, None))
+            q.put((end, None))
+        except Exception as e:
+            q.put((end, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = q.get()
+        if item is end:
+            if error is not None:
+                raise error
+            return
+        yield item
+
+
 def get_pmid(document: bioc.BioCDocument) -> Tuple[str, int]:
     infons = document.passages[0].infons
     if "article-id_pmid" in infons:
@@ -871,10 +930,10 @@ class DataGetter:
         text = passage.text[snippet_start:snippet_end]
         offsets -= snippet_start
 
-        head_start_marker = "[HEAD-S]"
-        head_end_marker = "[HEAD-E]"
-        tail_start_marker = "[TAIL-S]"
-        tail_end_marker = "[TAIL-E]"
+        head_start_marker = ENTITY_MARKERS["head_start"]
+        head_end_marker = ENTITY_MARKERS["head_end"]
+        tail_start_marker = ENTITY_MARKERS["tail_start"]
+        tail_end_marker = ENTITY_MARKERS["tail_end"]
 
         text_ent1 = passage.text[offset_ent1: offset_ent1 + len_ent1]
         text, offsets = replace_consistently(
@@ -915,9 +974,92 @@ class DataGetter:
         )
 
 
+def load_with_pickle_cache(source: Path, load):
+    """
+    Return the result of `load()`, which parses `source`. The result is pickled to
+    `cache_root` and read from there as long as the pickle is newer than `source`.
+    """
+    path_fingerprint = hashlib.sha1(str(Path(source).resolve()).encode()).hexdigest()
+    pickle_path = cache_root / "pickles" / f"{source.name}-{path_fingerprint[:12]}.pkl"
+    if pickle_path.exists() and pickle_path.stat().st_mtime >= source.stat().st_mtime:
+        with pickle_path.open("rb") as f:
+            return pickle.load(f)
+
+    result = load()
+
+    # Write to temporary file first so that concurrent runs never read a partial pickle
+    os.makedirs(pickle_path.parent, exist_ok=True)
+    fd, temp_filename = tempfile.mkstemp(dir=pickle_path.parent)
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_filename, pickle_path)
+
+    return result
+
+
+def get_model_cache_key(model_name_or_path: str) -> str:
+    """
+    Key for caching files derived from `model_name_or_path`. It changes whenever the
+    model's config file does, i.e. for a new hub revision, which lives in a different
+    snapshot directory, or for a checkpoint that was saved again to the same local path.
+    """
+    config_file = os.path.abspath(cached_file(str(model_name_or_path), "config.json"))
+    stat = os.stat(config_file)
+    fingerprint = hashlib.sha1(f"{config_file}:{stat.st_mtime_ns}:{stat.st_size}".encode()).hexdigest()
+
+    return str(model_name_or_path).strip("/").replace("/", "--") + "-" + fingerprint[:12]
+
+
+def get_tokenizer_cache_dir(model_name_or_path: str) -> Path:
+    """
+    Directory in which `get_tokenizer_and_config` caches the extended tokenizer and config.
+    Besides the model revision, it depends on the added tokens and the entity markers.
+    """
+    tokens_fingerprint = hashlib.sha1(json.dumps([SPECIAL_TOKENS, ENTITY_MARKERS],
+                                                 sort_keys=True).encode()).hexdigest()
+
+    return cache_root / "tokenizers" / (get_model_cache_key(model_name_or_path) + "-" + tokens_fingerprint[:12])
+
+
+def get_tokenizer_and_config(model_name_or_path: str) -> Tuple[BertTokenizerFast, BertConfig]:
+    """
+    Load the tokenizer of `model_name_or_path` extended by the entity marker tokens,
+    together with the model config. The config additionally holds the ids of the head
+    and tail start markers emitted by `DataGetter.get_sentence` as `e1_id` and `e2_id`.
+    Both are saved to `cache_root` on first use and loaded from there afterwards.
+    """
+    cache_dir = get_tokenizer_cache_dir(model_name_or_path)
+    if cache_dir.exists():
+        return BertTokenizerFast.from_pretrained(str(cache_dir)), BertConfig.from_pretrained(str(cache_dir))
+
+    tokenizer = BertTokenizerFast.from_pretrained(model_name_or_path)
+    tokenizer.add_special_tokens({ 'additional_special_tokens': SPECIAL_TOKENS})
+    config = BertConfig.from_pretrained(model_name_or_path,
+                                        e1_id=tokenizer.convert_tokens_to_ids(ENTITY_MARKERS["head_start"]),
+                                        e2_id=tokenizer.convert_tokens_to_ids(ENTITY_MARKERS["tail_start"]))
+
+    # Save to temporary directory first so that concurrent runs never load a partial copy
+    os.makedirs(cache_dir.parent, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=cache_dir.parent)
+    tokenizer.save_pretrained(temp_dir)
+    config.save_pretrained(temp_dir)
+    try:
+        os.rename(temp_dir, cache_dir)
+    except OSError:  # another run was faster
+        shutil.rmtree(temp_dir)
+
+    return tokenizer, config
+
+
+@lru_cache(maxsize=1)
 def get_geneid_to_name():
-    with open(root / "data" / "geneid_to_name.json") as f:
-        return json.load(f)
+    path = root / "data" / "geneid_to_name.json"
+
+    def load():
+        with open(path) as f:
+            return json.load(f)
+
+    return load_with_pickle_cache(path, load)
 
 
 def get_gene_mapping(from_db: str, to_db: str):
@@ -981,16 +1123,22 @@ def build_summary_table(
     return sorted(table, key=itemgetter(3), reverse=True)
 
 
+@lru_cache(maxsize=1)
 def get_hgnc_symbol_to_gene_id():
-    hgnc_symbol_to_gene_id = {}
     url = "http://ftp.ebi.ac.uk/pub/databases/genenames/hgnc/tsv/hgnc_complete_set.txt"
-    with open(cached_path(url, cache_dir=cache_root)) as f:
-        next(f)
-        for line in f:
-            fields = line.strip().split("\t")
-            if len(fields) > 18:
-                symbol = fields[1]
-                gene_id = fields[18]
-                hgnc_symbol_to_gene_id[symbol] = gene_id
+    path = cached_path(url, cache_dir=cache_root)
+
+    def load():
+        hgnc_symbol_to_gene_id = {}
+        with open(path) as f:
+            next(f)
+            for line in f:
+                fields = line.strip().split("\t")
+                if len(fields) > 18:
+                    symbol = fields[1]
+                    gene_id = fields[18]
+                    hgnc_symbol_to_gene_id[symbol] = gene_id
+
+        return hgnc_symbol_to_gene_id
 
-    return hgnc_symbol_to_gene_id
+    return load_with_pickle_cache(path, load)